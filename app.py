@@ -1,12 +1,17 @@
-# TODO Store retrieved documents in one array, then rerank collection and truncate to top 20
 # TODO Ask claude if the existing documents can answer the question, if not request document retrieval
 
 import re
+import time
+import asyncio
+import functools
+import hashlib
 import chainlit as cl
 import anthropic
+import httpx
 import voyageai
 import weaviate
 import weaviate.classes as wvc
+from rapidfuzz import fuzz, process, utils as fuzz_utils
 from weaviate.classes.query import Filter, HybridFusion, Metrics
 from weaviate.classes.aggregate import GroupByAggregate
 
@@ -58,119 +63,284 @@ Here is the user's query for this turn of the conversation:
 </user_query>
 """
 
+MODEL_CLASSIFIER_PROMPT = """
+You will be given a list of brands and models, followed by a user's query. Your task is to determine if the user's query contains mentions of any of the brands or models from the list. Exact matches are not necessary; you should look for close matches or variations as well. Consider common misspellings, abbreviations, or partial matches.
+
+First, here is the list of brands and models:
+<brands>
+{BRANDS}
+</brands>
+
+<models>
+{MODELS}
+</models>
+
+Now, here is the user's query:
+<user_query>
+{USER_QUERY}
+</user_query>
+
+<reasoning>
+Provide your reasoning here:
+</reasoning>
+
+Provide your response in the following format:
+
+<brands>
+List the matched brands here, one per line. If no matches were found, write "none"
+</brands>
+
+<models>
+List the matched models here, one per line. If no matches were found, write "none"
+</models>
+"""
+
+# The system prompt alone (~480 tokens) is under Sonnet's 1,024 token caching minimum, so it has no breakpoint
+# of its own. It is cached as the start of the prefix marked by the conversation history's breakpoint.
+SYSTEM_BLOCKS = [
+    {"type": "text", "text": SYSTEM_PROMPT},
+    {"type": "text", "text": INITIAL_PROMPT}
+]
+
+# Conversation history is only marked for caching once it has at least this many messages
+CACHE_HISTORY_THRESHOLD = 3
+
+# History only grows until it passes MAX_HISTORY_MESSAGES, then it is cut back to TRIMMED_HISTORY_MESSAGES in one step
+# and retrieved documents are only kept in full for the most recent FULL_DOCUMENT_MESSAGES. Trimming rewrites the
+# cached prefix, so doing it in coarse steps keeps the prefix reusable for several turns in between.
+FULL_DOCUMENT_MESSAGES = 4
+MAX_HISTORY_MESSAGES = 20
+TRIMMED_HISTORY_MESSAGES = 10
+
+# Retries for overloaded or dropped response streams
+STREAM_MAX_RETRIES = 3
+STREAM_RETRY_DELAY = 1
+
+# Over-retrieve candidates from Weaviate, then keep only the best few after reranking
+RETRIEVAL_LIMIT = 50
+RERANK_TOP_K = 5
+RERANK_MODEL = "rerank-2.5-lite"
+
+# Hybrid search weighting, 0 is pure BM25 and 1 is pure vector search.
+# Manuals are full of model numbers and parameter names, so keyword matches get an equal share.
+HYBRID_ALPHA = 0.5
+
+# Brands and models are fuzzy matched against runs of whole words in the query first. Scores (0-100) at or above
+# FUZZY_MATCH_CUTOFF are trusted, and if the best score only reaches FUZZY_FALLBACK_CUTOFF the query is ambiguous
+# and goes to Claude. Names shorter than MIN_FUZZY_CHOICE_LENGTH (like "s-1") look like too many ordinary words
+# to match loosely, so they have to appear exactly. Tuned so typos like "digitak" or "microfrek" still match
+# while generic questions ("how do I set up reverb on my synth") stay under the fallback cutoff.
+FUZZY_MATCH_CUTOFF = 90
+FUZZY_FALLBACK_CUTOFF = 70
+MIN_FUZZY_CHOICE_LENGTH = 4
+CLASSIFIER_MODEL = "claude-3-5-haiku-latest"
+
+# Brand/model lists only change when the corpus is re-ingested, so they are reused for this many seconds
+BRAND_MODEL_CACHE_TTL = 600
+
 # Set up needed clients
 claude_client = anthropic.AsyncAnthropic()
-weaviate_client = weaviate.connect_to_local()
+weaviate_client = weaviate.use_async_with_local()
 embedding_client = voyageai.Client()
 
-def extract_tag_value(text, tag_name):
+_BRANDS_CACHE = {"ts": 0, "brands": [], "models": []}
+
+# Matches any XML-like tag pair in an LLM response
+_TAG_RE = re.compile(r'<(\w+)>(.*?)</\1>', re.DOTALL)
+
+_weaviate_connect_lock = asyncio.Lock()
+_collection = None
+
+# In-flight embedding and search tasks, keyed by their inputs
+_inflight = {}
+
+async def _get_collection():
     """
-    Extract values from XML-like tags in a text.
-    
+    Get the Manuals collection, connecting the shared async Weaviate client on first use.
+
+    Returns:
+        CollectionAsync: The Manuals collection
+    """
+    global _collection
+
+    # The async client has to be connected from inside the running event loop, so it can't be done at import time
+    if not weaviate_client.is_connected():
+        async with _weaviate_connect_lock:
+            if not weaviate_client.is_connected():
+                await weaviate_client.connect()
+
+    # Reuse one collection handle rather than building a new one on every call
+    if _collection is None:
+        _collection = weaviate_client.collections.get("Manuals")
+
+    return _collection
+
+async def _single_flight(key, make_coroutine):
+    """
+    Run make_coroutine() once for all concurrent callers with the same key and share its result.
+    The LRU cache handles repeats over time, this handles identical requests arriving at the same time.
+
+    Args:
+        key (tuple): Identifies identical requests
+        make_coroutine (callable): Creates the coroutine doing the actual work
+
+    Returns:
+        The coroutine's result
+    """
+    task = _inflight.get(key)
+    if task is None:
+        task = asyncio.ensure_future(make_coroutine())
+        _inflight[key] = task
+        task.add_done_callback(lambda _: _inflight.pop(key, None))
+
+    # Shielded so one caller being cancelled doesn't cancel the work for everyone else
+    return await asyncio.shield(task)
+
+def extract_tags(text):
+    """
+    Extract the values of all XML-like tags in a text in a single pass.
+
     Args:
         text (str): Text to search in
+
+    Returns:
+        dict: Stripped tag values keyed by tag name, keeping the first occurrence of each tag
+    """
+    tags = {}
+    for match in _TAG_RE.finditer(text):
+        tags.setdefault(match.group(1), match.group(2).strip())
+
+    return tags
+
+def extract_tag_value(tags, tag_name):
+    """
+    Get a single value from tags parsed by extract_tags.
+    
+    Args:
+        tags (dict): Tag values from extract_tags
         tag_name (str): Name of the tag to extract from
         
     Returns:
-        string: Extracted value if no match or value is "none"
+        string: Extracted value, or an empty string if no match or value is "none"
     """
-    pattern = f'<{tag_name}>(.*?)</{tag_name}>'
-    match = re.search(pattern, text, re.DOTALL)
-    
-    if not match:
-        return []
-    
-    match_value = match.group(1).strip()
+    match_value = tags.get(tag_name, "")
     
     if match_value.lower() == "none":
-        return []
+        return ""
     
-    # Split by lines and filter out empty strings
     return match_value
 
-def extract_tag_values(text, tag_name):
+def extract_tag_values(tags, tag_name):
     """
-    Extract values from XML-like tags in a text.
+    Get a list of line separated values from tags parsed by extract_tags.
     
     Args:
-        text (str): Text to search in
+        tags (dict): Tag values from extract_tags
         tag_name (str): Name of the tag to extract from
         
     Returns:
         list: Extracted values or empty list if no match or value is "none"
     """
-    pattern = f'<{tag_name}>(.*?)</{tag_name}>'
-    match = re.search(pattern, text, re.DOTALL)
-    
-    if not match:
-        return []
-    
-    match_values = match.group(1).strip()
-    
-    if match_values.lower() == "none":
-        return []
+    match_values = extract_tag_value(tags, tag_name)
     
     # Split by lines and filter out empty strings
     return [line.strip() for line in match_values.splitlines() if line.strip()]
 
-@cl.step
-async def get_filters(query):
+async def _get_brand_model_lists():
+    """
+    Get the brands and models indexed in the Manuals collection, cached for BRAND_MODEL_CACHE_TTL seconds.
 
-    weaviate_client = weaviate.connect_to_local()
-    collection = weaviate_client.collections.get("Manuals")
+    Returns:
+        tuple: (brands, models) lists
+    """
+    if time.time() - _BRANDS_CACHE["ts"] < BRAND_MODEL_CACHE_TTL:
+        return _BRANDS_CACHE["brands"], _BRANDS_CACHE["models"]
+
+    collection = await _get_collection()
 
-    brand_response = collection.aggregate.over_all(
-        group_by=GroupByAggregate(prop="brand")
+    # GroupByAggregate only takes a single property, so run both aggregates concurrently instead
+    brand_response, model_response = await asyncio.gather(
+        collection.aggregate.over_all(group_by=GroupByAggregate(prop="brand")),
+        collection.aggregate.over_all(group_by=GroupByAggregate(prop="model"))
     )
 
     brands = []
     for group in brand_response.groups:
         brands.append(group.grouped_by.value)
 
-    model_response = collection.aggregate.over_all(
-        group_by=GroupByAggregate(prop="model")
-    )
-
     models = []
     for group in model_response.groups:
         models.append(group.grouped_by.value)
 
-    anthropic_client = anthropic.Client()
+    _BRANDS_CACHE.update({"ts": time.time(), "brands": brands, "models": models})
 
-    MODEL_CLASSIFIER_PROMPT = """
-    You will be given a list of brands and models, followed by a user's query. Your task is to determine if the user's query contains mentions of any of the brands or models from the list. Exact matches are not necessary; you should look for close matches or variations as well. Consider common misspellings, abbreviations, or partial matches.
+    return brands, models
 
-    First, here is the list of brands and models:
-    <brands>
-    {BRANDS}
-    </brands>
+def _word_ngrams(words, n):
+    # Joined without spaces so "op1", "op 1" and "op-1" all compare equal
+    return ["".join(words[i:i + n]) for i in range(len(words) - n + 1)]
 
-    <models>
-    {MODELS}
-    </models>
+def _fuzzy_match(query, choices):
+    """
+    Find the choices mentioned in a query, allowing for misspellings and different spacing or punctuation.
+    Each choice is only compared with runs of whole words of about its own length, so it can't match
+    part of an unrelated word the way a partial ratio over the raw query does.
 
-    Now, here is the user's query:
-    <user_query>
-    {USER_QUERY}
-    </user_query>
+    Args:
+        query (str): The user's query
+        choices (list): Known brands or models
 
-    <reasoning>
-    Provide your reasoning here:
-    </reasoning>
+    Returns:
+        tuple: (confidently matched choices, best score of any choice)
+    """
+    words = fuzz_utils.default_process(query).split()
+
+    matched = []
+    best_score = 0
+    for choice in choices:
+        # classify_content falls back to "Unknown" when a manual doesn't say, which shouldn't match anything
+        if not choice or choice == "unknown":
+            continue
+
+        choice_words = fuzz_utils.default_process(choice).split()
+        if not choice_words:
+            continue
+        target = "".join(choice_words)
+
+        # Allow one word more or less, e.g. "sub37" for "sub 37" or "circuit-tracks" for "circuit tracks"
+        candidates = [
+            ngram
+            for n in range(max(1, len(choice_words) - 1), len(choice_words) + 2)
+            for ngram in _word_ngrams(words, n)
+        ]
+        if not candidates:
+            continue
+
+        if len(target) < MIN_FUZZY_CHOICE_LENGTH:
+            score = 100 if target in candidates else 0
+        else:
+            score = process.extractOne(target, candidates, scorer=fuzz.ratio)[1]
 
-    Provide your response in the following format:
+        best_score = max(best_score, score)
+        if score >= FUZZY_MATCH_CUTOFF:
+            matched.append(choice)
 
-    <brands>
-    List the matched brands here, one per line. If no matches were found, write "none"
-    </brands>
+    return matched, best_score
 
-    <models>
-    List the matched models here, one per line. If no matches were found, write "none"
-    </models>
+async def _classify_with_claude(query, brands, models):
     """
+    Ask Claude which of the known brands and models a query mentions.
+
+    Args:
+        query (str): The user's query
+        brands (list): Known brands
+        models (list): Known models
 
-    llm_response = anthropic_client.messages.create(
-        model="claude-3-7-sonnet-latest",
+    Returns:
+        dict: Matched brands and models, with Claude's reasoning
+    """
+    llm_response = await claude_client.messages.create(
+        model=CLASSIFIER_MODEL,
         max_tokens=1024,
         temperature=0,
         messages=[
@@ -188,33 +358,70 @@ async def get_filters(query):
 
     filters = {"brands": [], "models": [], "reasoning": ""}
 
-    brands = extract_tag_values(llm_response.content[0].text, "brands")
+    tags = extract_tags(llm_response.content[0].text)
+
+    brands = extract_tag_values(tags, "brands")
     if brands:
         filters["brands"].extend(brands)
 
-    models = extract_tag_values(llm_response.content[0].text, "models")
+    models = extract_tag_values(tags, "models")
     if models:
         filters["models"].extend(models)
 
-    reasoning = extract_tag_value(llm_response.content[0].text, "reasoning")
+    reasoning = extract_tag_value(tags, "reasoning")
     if reasoning:
         filters["reasoning"] = reasoning
 
     return filters
 
-# Get studio documentation, passing property values as filters
 @cl.step
-async def get_documentation(query = "", filters = {"brands": [], "models": []}):
+async def get_filters(query):
+
+    brands, models = await _get_brand_model_lists()
+
+    matched_brands, brand_score = _fuzzy_match(query, brands)
+    matched_models, model_score = _fuzzy_match(query, models)
 
-    current_step = cl.context.current_step
+    # Only pay for an LLM call when something in the query resembles a known entity but didn't match confidently
+    if not matched_brands and not matched_models and max(brand_score, model_score) >= FUZZY_FALLBACK_CUTOFF:
+        return await _classify_with_claude(query, brands, models)
 
-    query_embeddings = embedding_client.embed(
+    return {
+        "brands": matched_brands,
+        "models": matched_models,
+        "reasoning": f"Fuzzy matched with a best brand score of {brand_score:.0f} and model score of {model_score:.0f}"
+    }
+
+@functools.lru_cache(maxsize=1024)
+def _embed_query(query):
+    """
+    Embed a user query for vector search. Results are memoized per process, so repeated queries skip Voyage.
+
+    Args:
+        query (str): The user's query
+
+    Returns:
+        list: Query embedding vector
+    """
+    return embedding_client.embed(
         [query],
         model="voyage-3",
         input_type="query"
     ).embeddings[0]
 
-    collection = weaviate_client.collections.get("Manuals")
+async def _hybrid_search(query, query_embeddings, filters):
+    """
+    Run a hybrid search over the Manuals collection.
+
+    Args:
+        query (str): The user's query, used for BM25
+        query_embeddings (list): Embedding of the query, used for vector search
+        filters (dict): Brands and models to restrict the search to
+
+    Returns:
+        dict: Document content keyed by object UUID
+    """
+    collection = await _get_collection()
 
     filterset = []
 
@@ -223,25 +430,23 @@ async def get_documentation(query = "", filters = {"brands": [], "models": []}):
     if len(filters["models"]) > 0:
         filterset.append(Filter.by_property("model").contains_any(filters["models"]))
 
-    if filterset:
-        response = collection.query.hybrid(
-            query=query,
-            filters=(
-                Filter.any_of(filterset)
-            ),
-            vector=query_embeddings,
-            limit=10,
-            fusion_type=HybridFusion.RELATIVE_SCORE,
-            return_metadata=wvc.query.MetadataQuery(certainty=True)
-        )
+    # Require both brand and model to match when both were extracted, so a right brand with the wrong model is excluded
+    if len(filterset) > 1:
+        combined_filter = Filter.all_of(filterset)
+    elif filterset:
+        combined_filter = filterset[0]
     else:
-        response = collection.query.hybrid(
-            query=query,
-            vector=query_embeddings,
-            limit=10,
-            fusion_type=HybridFusion.RELATIVE_SCORE,
-            return_metadata=wvc.query.MetadataQuery(certainty=True)
-        )
+        combined_filter = None
+
+    response = await collection.query.hybrid(
+        query=query,
+        filters=combined_filter,
+        vector=query_embeddings,
+        alpha=HYBRID_ALPHA,
+        limit=RETRIEVAL_LIMIT,
+        fusion_type=HybridFusion.RELATIVE_SCORE,
+        return_metadata=wvc.query.MetadataQuery(certainty=True)
+    )
 
     documents = {}
     for object in response.objects:
@@ -249,6 +454,121 @@ async def get_documentation(query = "", filters = {"brands": [], "models": []}):
 
     return documents
 
+def _rerank(query, documents, top_k=RERANK_TOP_K):
+    """
+    Rerank retrieved documents against the query and keep the most relevant.
+
+    Args:
+        query (str): The user's query
+        documents (dict): Document content keyed by object UUID
+        top_k (int): Number of documents to keep
+
+    Returns:
+        dict: The top_k documents keyed by object UUID, most relevant first
+    """
+    if not documents:
+        return {}
+
+    uuids = list(documents.keys())
+    reranking = embedding_client.rerank(
+        query=query,
+        documents=list(documents.values()),
+        model=RERANK_MODEL,
+        top_k=top_k
+    )
+
+    return {uuids[result.index]: result.document for result in reranking.results}
+
+# Get studio documentation, passing property values as filters
+@cl.step
+async def get_documentation(query = "", query_embeddings = None, filters = {"brands": [], "models": []}):
+
+    if query_embeddings is None:
+        query_embeddings = await _single_flight(("embed", query), lambda: asyncio.to_thread(_embed_query, query))
+
+    search_key = ("search", query, tuple(sorted(filters["brands"])), tuple(sorted(filters["models"])))
+    documents = await _single_flight(search_key, lambda: _hybrid_search(query, query_embeddings, filters))
+
+    # Dedupe the candidates before reranking, so duplicates neither cost rerank tokens nor take top_k slots
+    return await asyncio.to_thread(_rerank, query, _dedupe_documents(documents))
+
+def _cached_message(message):
+    return {
+        "role": message["role"],
+        "content": [{"type": "text", "text": message["content"], "cache_control": {"type": "ephemeral"}}]
+    }
+
+def _with_cache_breakpoint(messages):
+    """
+    Copy the conversation for a request, marking the latest user turn as a prompt cache breakpoint.
+    The previous user turn is marked too, which is where the last request's breakpoint was, so the
+    prefix cached by the last turn is read back even though the latest turn is a new cache write.
+
+    Args:
+        messages (list): Conversation history with plain string content
+
+    Returns:
+        list: Messages to send to Claude
+    """
+    if len(messages) < CACHE_HISTORY_THRESHOLD:
+        return messages
+
+    # The stored history is left untouched so cache_control markers never pile up past the API's limit
+    messages = list(messages)
+    messages[-1] = _cached_message(messages[-1])
+    if len(messages) >= 3:
+        messages[-3] = _cached_message(messages[-3])
+
+    return messages
+
+def _dedupe_documents(documents):
+    """
+    Drop retrieved documents whose content is identical to an earlier one.
+
+    Args:
+        documents (dict): Document content keyed by object UUID
+
+    Returns:
+        dict: Unique document content keyed by object UUID, in retrieval order
+    """
+    seen = set()
+    unique_documents = {}
+    for uuid, content in documents.items():
+        digest = hashlib.blake2b(content.encode(), digest_size=16).digest()
+        if digest in seen:
+            continue
+        seen.add(digest)
+        unique_documents[uuid] = content
+
+    return unique_documents
+
+def _trim_history(messages):
+    """
+    Bound the conversation history so each turn's input tokens don't keep growing with the session.
+    Between trims the history is only appended to, so every request starts with the previous request's
+    cached prefix. Once it passes MAX_HISTORY_MESSAGES the oldest exchanges are dropped down to
+    TRIMMED_HISTORY_MESSAGES and older user turns keep only their query, costing one cache write.
+
+    Args:
+        messages (list): Conversation history, modified in place
+
+    Returns:
+        list: The trimmed history
+    """
+    if len(messages) <= MAX_HISTORY_MESSAGES:
+        return messages
+
+    # Drop whole user/assistant pairs so the history still starts with a user turn
+    excess = len(messages) - TRIMMED_HISTORY_MESSAGES
+    del messages[:excess + excess % 2]
+
+    for message in messages[:-FULL_DOCUMENT_MESSAGES]:
+        if message["role"] == "user" and "<retrieved_documents>" in message["content"]:
+            user_query = extract_tags(message["content"]).get("user_query", "")
+            message["content"] = f"<user_query>\n{user_query}\n</user_query>"
+
+    return messages
+
 # Call to Claude
 async def call_claude(query: str, documents = {}):
 
@@ -256,37 +576,54 @@ async def call_claude(query: str, documents = {}):
 
     messages.append({"role": "user", "content": TURN_TEMPLATE.format(RETRIEVED_DOCUMENTS="\n".join(documents.values()), USER_QUERY=query)})
 
-    claude_response = await claude_client.messages.create(
-        model="claude-3-7-sonnet-latest",
-        system=SYSTEM_PROMPT,
-        messages=messages,
-        max_tokens=8192,
-        stream=False
-    )
-
-    # Streaming is really brittle when overloaded.
-    # async for data in stream:
-    #     if data.type == "content_block_delta":
-    #         await response.stream_token(data.delta.text)
-
     response = cl.Message(
-        content=f"{claude_response.content[0].text}",
+        content="",
         author="Claude"
     )
 
+    # Streaming is brittle when Claude is overloaded, so restart the response with exponential backoff
+    retry_delay = STREAM_RETRY_DELAY
+    for attempt in range(STREAM_MAX_RETRIES):
+        try:
+            stream = await claude_client.messages.create(
+                model="claude-3-7-sonnet-latest",
+                system=SYSTEM_BLOCKS,
+                messages=_with_cache_breakpoint(messages),
+                max_tokens=8192,
+                stream=True
+            )
+
+            async for data in stream:
+                if data.type == "content_block_delta":
+                    await response.stream_token(data.delta.text)
+            break
+        except (anthropic.APIStatusError, anthropic.APIConnectionError, httpx.TransportError) as e:
+            # Errors raised mid-stream carry the 200 status of the original response. Connections dropped
+            # while the stream is being read surface as httpx errors, the SDK only wraps them before the response.
+            if isinstance(e, anthropic.APIStatusError):
+                retryable = e.status_code >= 500 or e.status_code in (200, 429)
+            else:
+                retryable = True
+            if not retryable or attempt == STREAM_MAX_RETRIES - 1:
+                raise
+
+            # Drop any partial output before streaming the response again
+            if response.content:
+                response.content = ""
+                await response.update()
+            await asyncio.sleep(retry_delay)
+            retry_delay *= 2
+
     await response.send()
     messages.append({"role": "assistant", "content": response.content})
-    cl.user_session.set("messages", messages)
+    cl.user_session.set("messages", _trim_history(messages))
 
 # Start up session
 @cl.on_chat_start
 async def start_chat():
 
-    start_messages = []
-    start_messages.append({"role": "user", "content": INITIAL_PROMPT})
-    start_messages.append({"role": "assistant", "content": "Understood"})
-
-    cl.user_session.set("messages", start_messages)
+    # INITIAL_PROMPT is sent as part of the system prompt, so history starts empty
+    cl.user_session.set("messages", [])
     cl.user_session.set("entities", {"brands": [], "models": []})
 
 # Send message to Claude
@@ -295,8 +632,20 @@ async def chat(message: cl.Message):
 
     entities = cl.user_session.get("entities")
 
-    # Only query documentation if the session has mentioned specific entities
-    filters = await get_filters(message.content)
+    # Once the session has entities every turn retrieves documents, so embed the query while entities are extracted.
+    # Otherwise wait for the classifier, most turns without entities never need an embedding.
+    embed_task = None
+    if entities["brands"] or entities["models"]:
+        embed_task = asyncio.create_task(
+            _single_flight(("embed", message.content), lambda: asyncio.to_thread(_embed_query, message.content))
+        )
+
+    try:
+        filters = await get_filters(message.content)
+    except BaseException:
+        if embed_task is not None:
+            embed_task.cancel()
+        raise
 
     if len(filters["brands"]) > 0 or len(filters["models"]) > 0:
         # TODO: test whether aggregating or replacing entities works better.
@@ -305,8 +654,10 @@ async def chat(message: cl.Message):
         entities = filters
         cl.user_session.set("entities", entities)
 
+    # Only query documentation if the session has mentioned specific entities
     if entities["brands"] or entities["models"]:
-        documents = await get_documentation(message.content, entities)
+        query_embeddings = await embed_task if embed_task is not None else None
+        documents = await get_documentation(message.content, query_embeddings, entities)
     else:
         documents = {}
 
@@ -2,17 +2,26 @@
 """
 Embedding Generator
 ------------------
-This script processes JSON files from specified folders, generates embeddings
-using the Voyage AI API, and saves the results to an output directory.
+This script processes the chunks.jsonl file in each chunk folder, generates
+embeddings using the Voyage AI API, and saves the results to an output directory.
+Each folder's chunks are saved to chunks.jsonl with their embeddings in
+embeddings.npy (float16), row i holding the embedding of line i.
 """
 
 import voyageai
+import numpy as np
 import os
-import json
+import orjson
+import shutil
 import sys
+import argparse
 from pathlib import Path
 import logging
 import time
+import hashlib
+import sqlite3
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 # Configure logging
 logging.basicConfig(
@@ -24,8 +33,168 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Constants
+EMBEDDING_MODEL = "voyage-3"
+CACHE_PATH = "output/embedding_cache.sqlite"
+BATCH_SIZE = 96  # voyage-3 accepts up to 128 documents per request
+MAX_WORKERS = 4  # Embedding is I/O bound, so batches are sent concurrently
+IO_WORKERS = 8  # Threads reading and writing chunk files while batches are embedded
+MAX_QUEUED_BATCHES = 2 * MAX_WORKERS  # Embedding batches in flight before reading more folders pauses
+CHUNKS_FILENAME = "chunks.jsonl"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+
+def content_hash(text: str) -> str:
+    """Hash the text that gets embedded for a chunk."""
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+class EmbeddingCache:
+    """
+    Disk-backed cache of embeddings keyed by (model, input_type, sha256(text)),
+    so re-runs only pay for text that hasn't been embedded before.
+    """
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB NOT NULL)")
+        self.connection.commit()
+
+    @staticmethod
+    def key(model: str, input_type: str, text: str) -> str:
+        return f"{model}:{input_type}:{content_hash(text)}"
+
+    def get(self, key: str):
+        row = self.connection.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+        return orjson.loads(row[0]) if row else None
+
+    def set(self, key: str, embedding) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+            (key, orjson.dumps(embedding))
+        )
+        self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+def embed_documents(embedding_client, documents, max_retries=3, retry_delay=2):
+    """Embed documents with Voyage AI, backing off exponentially on rate limits."""
+    for retry in range(max_retries):
+        try:
+            return embedding_client.embed(
+                documents,
+                model=EMBEDDING_MODEL,
+                input_type="document"
+            )
+        except voyageai.error.RateLimitError:
+            if retry < max_retries - 1:
+                logger.warning(f"Rate limit hit, retrying in {retry_delay} seconds (attempt {retry+1}/{max_retries})")
+                time.sleep(retry_delay)
+                retry_delay *= 2  # Exponential backoff
+            else:
+                raise
+
+def read_chunks(file_path):
+    """
+    Read a folder's chunks.jsonl and prepare each chunk for embedding.
+
+    Returns:
+        list: The chunks in file order, with None for lines that are invalid or missing required fields
+    """
+    logger.info(f"Processing: {file_path}")
+    
+    chunks = []
+    with open(file_path, 'rb') as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            
+            source = f"{file_path}:{line_number}"
+            try:
+                data = orjson.loads(line)
+            except orjson.JSONDecodeError as e:
+                logger.error(f"Invalid JSON in {source}: {e}")
+                chunks.append(None)
+                continue
+            
+            # Prepare document for embedding
+            if 'id' not in data or 'content' not in data or 'contextualization' not in data:
+                logger.warning(f"Chunk {source} is missing required fields 'id', 'content' or 'contextualization'")
+                chunks.append(None)
+                continue
+            
+            text = data['content'] + "\n\n" + data['contextualization']
+            chunks.append({
+                'source': source,
+                'data': data,
+                'text': text,
+                'cache_key': EmbeddingCache.key(EMBEDDING_MODEL, "document", text),
+                'embeddings': None
+            })
+    return chunks
+
+def embed_batch(embedding_client, batch):
+    """
+    Embed a batch of pending chunks in a single request. If the batch request fails,
+    each chunk is retried on its own so one bad document doesn't fail the rest.
+
+    Returns:
+        list: (chunk, embeddings) tuples, with embeddings set to None on failure
+    """
+    try:
+        embedding_response = embed_documents(embedding_client, [chunk['text'] for chunk in batch])
+        if len(embedding_response.embeddings) == len(batch):
+            return list(zip(batch, embedding_response.embeddings))
+        logger.warning(f"Received {len(embedding_response.embeddings)} embeddings for {len(batch)} documents, retrying individually")
+    except Exception as e:
+        logger.warning(f"Batch embedding failed, retrying {len(batch)} documents individually: {e}")
+
+    results = []
+    for chunk in batch:
+        try:
+            embedding_response = embed_documents(embedding_client, [chunk['text']])
+            
+            # Validate embedding response
+            if not hasattr(embedding_response, 'embeddings') or not embedding_response.embeddings:
+                logger.error(f"Empty or invalid embedding response for {chunk['source']}")
+                results.append((chunk, None))
+                continue
+                
+            results.append((chunk, embedding_response.embeddings[0]))
+        except voyageai.error.VoyageError as e:
+            logger.error(f"Voyage API error for {chunk['source']}: {e}")
+            results.append((chunk, None))
+        except Exception as e:
+            logger.error(f"Failed to generate embeddings for {chunk['source']}: {e}")
+            results.append((chunk, None))
+    return results
+
+def save_embedded_chunks(output_folder, chunks):
+    """
+    Write a folder's chunks and embeddings. The embeddings are stored as one compact float16
+    matrix in embeddings.npy, next to the chunks' JSON lines, instead of JSON float arrays.
+    """
+    # Save the embeddings first, so the chunks file always has its vectors on disk
+    np.save(os.path.join(output_folder, EMBEDDINGS_FILENAME), np.asarray([chunk['embeddings'] for chunk in chunks], dtype=np.float16))
+    with open(os.path.join(output_folder, CHUNKS_FILENAME), 'wb') as f:
+        f.write(b"".join(orjson.dumps(chunk['data']) + b"\n" for chunk in chunks))
+
+def is_already_embedded(chunks_path, output_folder):
+    """Check whether a folder's chunks already have up to date outputs, without reading them."""
+    output_path = os.path.join(output_folder, CHUNKS_FILENAME)
+    try:
+        # Outputs older than the source chunks are stale, e.g. after re-running md_to_chunks
+        return os.path.getmtime(output_path) >= os.path.getmtime(chunks_path)
+    except OSError:
+        return False
+
 def main():
     """Main function to process JSON files and generate embeddings."""
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Generate Voyage AI embeddings for chunk files')
+    parser.add_argument('--force', action='store_true', help='Re-embed chunks even if their outputs already exist')
+    args = parser.parse_args()
+    
     try:
         # Initialize the Voyage AI client
         try:
@@ -42,6 +211,13 @@ def main():
             logger.error(f"Failed to initialize Voyage AI client: {e}")
             sys.exit(1)
         
+        # Open the embedding cache
+        try:
+            embedding_cache = EmbeddingCache(CACHE_PATH)
+        except sqlite3.Error as e:
+            logger.error(f"Failed to open embedding cache '{CACHE_PATH}': {e}")
+            sys.exit(1)
+
         # Define the root folder path
         root_folder = "output/chunks"
         
@@ -53,19 +229,32 @@ def main():
         # Process each subfolder
         processed_count = 0
         error_count = 0
+        skipped_count = 0
+        pending = []
+        subdir_queue = deque()
+        # Folders that have been read but not written yet, by name, and the work in flight for them
+        subdirs = {}
+        futures = {}
         
         # List all items in the root folder
         try:
-            subdirs = os.listdir(root_folder)
+            subdir_entries = os.scandir(root_folder)
         except Exception as e:
             logger.error(f"Failed to list contents of '{root_folder}': {e}")
             sys.exit(1)
         
-        for subdir_name in subdirs:
-            subdir_path = os.path.join(root_folder, subdir_name)
-            
-            # Check if this is a subfolder (not a file)
-            if os.path.isdir(subdir_path):
+        # Chunk files are read and written by a pool of I/O threads while full batches are embedded concurrently.
+        # The SQLite cache and the counters are only ever touched from this thread.
+        with subdir_entries, \
+                ThreadPoolExecutor(max_workers=IO_WORKERS) as io_executor, \
+                ThreadPoolExecutor(max_workers=MAX_WORKERS) as embed_executor:
+            for subdir_entry in subdir_entries:
+                # Check if this is a subfolder (not a file)
+                if not subdir_entry.is_dir():
+                    continue
+                
+                subdir_name = subdir_entry.name
+                subdir_path = subdir_entry.path
                 logger.info(f"Processing subfolder: {subdir_name}")
                 
                 # Create output folder if it doesn't exist
@@ -76,125 +265,129 @@ def main():
                     logger.error(f"Failed to create output folder '{output_folder}': {e}")
                     continue
                 
-                # Get all JSON files in the current subfolder
+                # Copy the metadata file as is, there's nothing to parse or change
+                metadata_path = os.path.join(subdir_path, "metadata.json")
                 try:
-                    json_files = [f for f in os.listdir(subdir_path) if f.lower().endswith('.json')]
+                    shutil.copyfile(metadata_path, os.path.join(output_folder, "metadata.json"))
+                except FileNotFoundError:
+                    logger.warning(f"No metadata.json in '{subdir_path}'")
                 except Exception as e:
-                    logger.error(f"Failed to list JSON files in '{subdir_path}': {e}")
+                    logger.error(f"Error processing metadata file {metadata_path}: {e}")
+                    error_count += 1
+                
+                chunks_path = os.path.join(subdir_path, CHUNKS_FILENAME)
+                if not os.path.exists(chunks_path):
+                    logger.warning(f"No {CHUNKS_FILENAME} in '{subdir_path}'")
                     continue
                 
-                # Process each JSON file
-                for json_file in json_files:
-                    file_path = os.path.join(subdir_path, json_file)
-                    logger.info(f"Processing: {file_path}")
-                    
-                    # Handle metadata.json specially
-                    if json_file == "metadata.json":
+                # Re-runs only pay for folders whose chunks have changed, and the cache covers the chunks that haven't
+                if not args.force and is_already_embedded(chunks_path, output_folder):
+                    skipped_count += 1
+                    continue
+                
+                subdir_queue.append((subdir_name, output_folder, chunks_path))
+            
+            # Each folder is written as soon as its last chunk has embeddings and then dropped, so only the
+            # folders in flight are held in memory and reads, embedding and writes keep overlapping
+            while subdir_queue or futures:
+                # Stop reading ahead while embedding is behind
+                reads_in_flight = sum(1 for kind, _ in futures.values() if kind == 'read')
+                batches_in_flight = sum(1 for kind, _ in futures.values() if kind == 'embed')
+                while subdir_queue and reads_in_flight < IO_WORKERS and batches_in_flight < MAX_QUEUED_BATCHES:
+                    subdir_name, output_folder, chunks_path = subdir_queue.popleft()
+                    futures[io_executor.submit(read_chunks, chunks_path)] = ('read', (subdir_name, output_folder, chunks_path))
+                    reads_in_flight += 1
+                
+                # Embed the final partial batch once no more chunks are coming
+                if pending and not subdir_queue and reads_in_flight == 0:
+                    logger.info(f"Embedding batch of {len(pending)} documents...")
+                    futures[embed_executor.submit(embed_batch, embedding_client, pending)] = ('embed', None)
+                    pending = []
+                
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                ready = []
+                for future in done:
+                    kind, task = futures.pop(future)
+                    if kind == 'read':
+                        subdir_name, output_folder, chunks_path = task
                         try:
-                            # Read the metadata file
-                            with open(file_path, 'r', encoding='utf-8') as f:
-                                data = json.load(f)
-                            
-                            # Create the output path
-                            output_path = os.path.join(output_folder, "metadata.json")
-                            
-                            # Save metadata file as is
-                            with open(output_path, 'w', encoding='utf-8') as f:
-                                json.dump(data, f, ensure_ascii=False, indent=2)
-                            
-                            processed_count += 1
-                            continue
-                        except json.JSONDecodeError as e:
-                            logger.error(f"Invalid JSON in metadata file {file_path}: {e}")
-                            error_count += 1
-                            continue
+                            chunks = future.result()
                         except Exception as e:
-                            logger.error(f"Error processing metadata file {file_path}: {e}")
+                            logger.error(f"Error processing {chunks_path}: {e}")
                             error_count += 1
                             continue
-                    
-                    # Process regular JSON files
-                    try:
-                        # Read and parse the JSON file
-                        with open(file_path, 'r', encoding='utf-8') as f:
-                            data = json.load(f)
-                        
-                        # Prepare document for embedding
-                        if 'content' not in data or 'contextualization' not in data:
-                            logger.warning(f"File {file_path} is missing required fields 'content' or 'contextualization'")
-                            error_count += 1
-                            continue
-                        
-                        documents = [data['content'] + "\n\n" + data['contextualization']]
                         
-                        # Generate embeddings
-                        try:
-                            # Add retry logic for API calls
-                            max_retries = 3
-                            retry_delay = 2
+                        subdir = {'output_folder': output_folder, 'chunks': [], 'remaining': 0, 'failed': 0}
+                        subdirs[subdir_name] = subdir
+                        for chunk in chunks:
+                            if chunk is None:
+                                error_count += 1
+                                continue
                             
-                            for retry in range(max_retries):
-                                try:
-                                    embedding_response = embedding_client.embed(
-                                        documents,
-                                        model="voyage-3",
-                                        input_type="document"
-                                    )
-                                    break
-                                except voyageai.error.RateLimitError:
-                                    if retry < max_retries - 1:
-                                        logger.warning(f"Rate limit hit, retrying in {retry_delay} seconds (attempt {retry+1}/{max_retries})")
-                                        time.sleep(retry_delay)
-                                        retry_delay *= 2  # Exponential backoff
-                                    else:
-                                        raise
+                            # Skip Voyage entirely on a cache hit, otherwise queue the chunk and embed it once its batch is full
+                            subdir['chunks'].append(chunk)
+                            chunk['subdir'] = subdir_name
+                            chunk['embeddings'] = embedding_cache.get(chunk['cache_key'])
+                            if chunk['embeddings'] is None:
+                                subdir['remaining'] += 1
+                                pending.append(chunk)
+                                if len(pending) == BATCH_SIZE:
+                                    logger.info(f"Embedding batch of {len(pending)} documents...")
+                                    futures[embed_executor.submit(embed_batch, embedding_client, pending)] = ('embed', None)
+                                    pending = []
+                        
+                        if subdir['remaining'] == 0:
+                            ready.append(subdir_name)
+                    
+                    elif kind == 'embed':
+                        for chunk, embeddings in future.result():
+                            subdir = subdirs[chunk['subdir']]
+                            subdir['remaining'] -= 1
+                            if subdir['remaining'] == 0:
+                                ready.append(chunk['subdir'])
                             
-                            # Validate embedding response
-                            if not hasattr(embedding_response, 'embeddings') or not embedding_response.embeddings:
-                                logger.error(f"Empty or invalid embedding response for {file_path}")
+                            if embeddings is None:
                                 error_count += 1
+                                subdir['failed'] += 1
                                 continue
-                                
-                            embeddings = embedding_response.embeddings[0]
-                        except voyageai.error.VoyageError as e:
-                            logger.error(f"Voyage API error for {file_path}: {e}")
-                            error_count += 1
-                            continue
+                            
+                            try:
+                                embedding_cache.set(chunk['cache_key'], embeddings)
+                            except sqlite3.Error as e:
+                                logger.warning(f"Failed to cache embeddings for {chunk['source']}: {e}")
+                            
+                            chunk['embeddings'] = embeddings
+                    
+                    else:
+                        # The folder's chunks are released once its outputs are on disk
+                        subdir = subdirs.pop(task)
+                        try:
+                            future.result()
+                            processed_count += len(subdir['chunks'])
                         except Exception as e:
-                            logger.error(f"Failed to generate embeddings for {file_path}: {e}")
-                            error_count += 1
-                            continue
-                        
-                        # Add embeddings to data
-                        data['embeddings'] = embeddings
-                        
-                        # Define the output filename and path
-                        if 'id' not in data:
-                            logger.warning(f"File {file_path} is missing 'id' field, using original filename")
-                            filename = json_file
-                        else:
-                            filename = f"{data['id']}.json"
-                        
-                        output_path = os.path.join(output_folder, filename)
-                        
-                        # Save the enriched data
-                        with open(output_path, 'w', encoding='utf-8') as f:
-                            json.dump(data, f, ensure_ascii=False, indent=2)
-                        
-                        processed_count += 1
-                        
-                    except json.JSONDecodeError as e:
-                        logger.error(f"Invalid JSON in {file_path}: {e}")
-                        error_count += 1
-                    except Exception as e:
-                        logger.error(f"Error processing {file_path}: {e}")
-                        error_count += 1
+                            logger.error(f"Error saving {subdir['output_folder']}: {e}")
+                            error_count += len(subdir['chunks'])
+                
+                # Each folder is written in one go once all of its chunks have embeddings
+                for subdir_name in ready:
+                    subdir = subdirs[subdir_name]
+                    if subdir['failed']:
+                        # Leave the previous output in place so the next run retries this folder, the cache keeps the rest
+                        logger.error(f"Not saving {subdir_name}: {subdir['failed']} chunks failed to embed")
+                        del subdirs[subdir_name]
+                        continue
+                    
+                    futures[io_executor.submit(save_embedded_chunks, subdir['output_folder'], subdir['chunks'])] = ('write', subdir_name)
+        
+        embedding_cache.close()
         
         # Log completion summary
         logger.info(f"Embedding generation completed.")
-        logger.info(f"Processed {processed_count} files successfully.")
+        logger.info(f"Processed {processed_count} chunks successfully.")
+        if skipped_count > 0:
+            logger.info(f"Skipped {skipped_count} already embedded folders.")
         if error_count > 0:
-            logger.warning(f"Encountered errors in {error_count} files.")
+            logger.warning(f"Encountered errors in {error_count} chunks.")
             
     except KeyboardInterrupt:
         logger.info("Process interrupted by user. Exiting...")
@@ -7,10 +7,15 @@ A command line utility to load embedded document chunks into a Weaviate collecti
 
 import os
 import sys
-import json
+import atexit
+import functools
 import logging
 import traceback
-from typing import Dict, Any, List
+import numpy as np
+import orjson
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Tuple
 import weaviate
 import weaviate.classes as wvc
 from weaviate.exceptions import WeaviateQueryError
@@ -26,13 +31,22 @@ logger = logging.getLogger(__name__)
 # Constants
 COLLECTION_NAME = "Manuals"
 ROOT_FOLDER = "output/embeddings"  # Default path
+READ_WORKERS = 8  # Threads loading chunk files while the batcher sends objects
+CHUNKS_FILENAME = "chunks.jsonl"
+EMBEDDINGS_FILENAME = "embeddings.npy"  # Row i is the embedding of line i in chunks.jsonl
+DELETE_BATCH_SIZE = 1000  # Ids per delete_many filter, well under the server's query limit
 
-def connect_to_weaviate() -> weaviate.WeaviateClient:
+@functools.lru_cache(maxsize=1)
+def _get_client() -> weaviate.WeaviateClient:
+    """Connect to Weaviate once per process, the connection is closed when the process exits."""
     try:
-        client = weaviate.connect_to_local()
-        if not client.is_ready():
-            logger.error("Weaviate connection is not ready. Please ensure Weaviate is running.")
-            sys.exit(1)
+        # connect_to_local already fails fast if Weaviate isn't reachable, so no separate is_ready() check.
+        # Large batches can take a while to insert, so allow them more time than the default.
+        client = weaviate.connect_to_local(
+            grpc_port=50051,
+            additional_config=wvc.init.AdditionalConfig(timeout=wvc.init.Timeout(insert=120))
+        )
+        atexit.register(client.close)
         logger.info("Connected to Weaviate successfully.")
         return client
     except Exception as e:
@@ -43,14 +57,21 @@ def connect_to_weaviate() -> weaviate.WeaviateClient:
 def check_and_setup_collection(client: weaviate.WeaviateClient):
     try:
         if client.collections.exists(COLLECTION_NAME):
-            logger.info(f"Collection '{COLLECTION_NAME}' already exists.")
+            logger.info(f"Collection '{COLLECTION_NAME}' already exists. Quantization settings only apply to new collections.")
             return client.collections.get(COLLECTION_NAME)
         
         # Create a new collection
         logger.info(f"Creating collection '{COLLECTION_NAME}'...")
         collection = client.collections.create(
             COLLECTION_NAME,
-            vectorizer_config=wvc.config.Configure.Vectorizer.none()
+            vectorizer_config=wvc.config.Configure.Vectorizer.none(),
+            # Binary quantization shrinks vectors in memory ~32x and speeds up HNSW traversal, and unlike PQ/SQ
+            # it needs no training set. It does cost some vector recall, which the reranker can't recover since it
+            # only reorders what search returns. The app limits the impact by over-retrieving candidates and
+            # weighting BM25, which quantization doesn't affect, equally in hybrid search.
+            vector_index_config=wvc.config.Configure.VectorIndex.hnsw(
+                quantizer=wvc.config.Configure.VectorIndex.Quantizer.bq()
+            )
         )
         logger.info(f"Collection '{COLLECTION_NAME}' created successfully.")
         return collection
@@ -62,12 +83,12 @@ def check_and_setup_collection(client: weaviate.WeaviateClient):
 
 def load_metadata(metadata_file: str) -> Dict[str, Any]:
     try:
-        with open(metadata_file, 'r') as f:
-            return json.load(f)
+        with open(metadata_file, 'rb') as f:
+            return orjson.loads(f.read())
     except FileNotFoundError:
         logger.error(f"Metadata file not found: {metadata_file}")
         return {}
-    except json.JSONDecodeError:
+    except orjson.JSONDecodeError:
         logger.error(f"Invalid JSON in metadata file: {metadata_file}")
         return {}
     except Exception as e:
@@ -75,10 +96,75 @@ def load_metadata(metadata_file: str) -> Dict[str, Any]:
         return {}
 
 
+def read_chunks(subdir_path: str, base_properties: Dict[str, Any]) -> List[Tuple[str, np.ndarray, Dict[str, Any]]]:
+    """Read a subdirectory's chunks and embeddings, returning (uuid, vector, properties) for each valid chunk."""
+    chunks_path = os.path.join(subdir_path, CHUNKS_FILENAME)
+    
+    # Load the embeddings, stored as one float16 matrix to save space. The client accepts numpy arrays,
+    # so each vector stays a float32 row of a single buffer instead of a list of Python floats
+    vectors = np.load(os.path.join(subdir_path, EMBEDDINGS_FILENAME)).astype(np.float32)
+    
+    chunks = []
+    with open(chunks_path, 'rb') as f:
+        lines = [line for line in f if line.strip()]
+    
+    # Row i of the embeddings belongs to line i of the chunks file
+    if len(lines) != len(vectors):
+        raise ValueError(f"{chunks_path} has {len(lines)} chunks but {len(vectors)} embeddings")
+    
+    for line_number, (line, vector) in enumerate(zip(lines, vectors), start=1):
+        # Load the JSON data
+        try:
+            data = orjson.loads(line)
+        except orjson.JSONDecodeError:
+            logger.error(f"Invalid JSON format in {chunks_path} line {line_number}")
+            continue
+        
+        # Validate required fields
+        if not all(key in data for key in ["id", "content"]):
+            logger.warning(f"Skipping {chunks_path} line {line_number}: Missing required fields.")
+            continue
+        
+        # The document level properties are shared by every chunk in the subdirectory
+        properties = {**base_properties, "content": data["content"]}
+        chunks.append((data["id"], vector, properties))
+    
+    return chunks
+
+
+def read_in_window(executor, subdirectories):
+    """
+    Read subdirectories on the executor, yielding (path, future) in order with at most READ_WORKERS reads
+    ahead of the caller, so only the subdirectories in flight are held in memory.
+    """
+    window = deque()
+    for subdir_path, base_properties in subdirectories:
+        window.append((subdir_path, executor.submit(read_chunks, subdir_path, base_properties)))
+        if len(window) >= READ_WORKERS:
+            yield window.popleft()
+    while window:
+        yield window.popleft()
+
+
+def delete_stale_objects(collection, current_ids: set) -> int:
+    """Delete objects whose ids no longer appear in any chunk file, e.g. text from a re-converted page."""
+    stale_ids = [str(obj.uuid) for obj in collection.iterator() if str(obj.uuid) not in current_ids]
+    for start in range(0, len(stale_ids), DELETE_BATCH_SIZE):
+        collection.data.delete_many(
+            where=wvc.query.Filter.by_id().contains_any(stale_ids[start:start + DELETE_BATCH_SIZE])
+        )
+    return len(stale_ids)
+
+
 def load_embeddings(collection, root_folder: str) -> None:
-    """Load embeddings from JSON files into Weaviate collection."""
-    total_files = 0
+    """Load embeddings from each subdirectory's chunk files into Weaviate collection."""
+    total_chunks = 0
+    subdirectories = []
+    queued_imports = 0
     successful_imports = 0
+    # Ids in this run's chunk files, only trusted for pruning when every subdirectory was read
+    current_ids = set()
+    all_read = True
     
     try:
         # Check if root folder exists
@@ -86,79 +172,86 @@ def load_embeddings(collection, root_folder: str) -> None:
             logger.error(f"Root folder not found: {root_folder}")
             sys.exit(1)
             
-        # Process each subfolder in the root folder
-        for subdir_name in os.listdir(root_folder):
-            subdir_path = os.path.join(root_folder, subdir_name)
+        # Dynamic batching sends objects in a few large requests, sized to the server's load, instead of one request each
+        with collection.batch.dynamic() as batch, ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+            # Process each subfolder in the root folder, scandir entries carry their type so no extra stat() is needed
+            with os.scandir(root_folder) as subdirs:
+                subdir_entries = [entry for entry in subdirs if entry.is_dir()]
             
-            # Skip if not a directory
-            if not os.path.isdir(subdir_path):
-                continue
+            for subdir_entry in subdir_entries:
+                subdir_name = subdir_entry.name
+                subdir_path = subdir_entry.path
                 
-            # Load metadata for this subdirectory
-            metadata_file = os.path.join(subdir_path, 'metadata.json')
-            metadata = load_metadata(metadata_file)
+                # Load metadata for this subdirectory
+                metadata_file = os.path.join(subdir_path, 'metadata.json')
+                metadata = load_metadata(metadata_file)
             
-            if not metadata:
-                logger.warning(f"Skipping subdirectory {subdir_name} due to missing or invalid metadata.")
-                continue
+                if not metadata:
+                    logger.warning(f"Skipping subdirectory {subdir_name} due to missing or invalid metadata.")
+                    all_read = False
+                    continue
                 
-            # Find all JSON files (except metadata.json)
-            json_files = [f for f in os.listdir(subdir_path) 
-                         if f.lower().endswith('.json') and f != "metadata.json"]
+                # Prepare properties with lowercase values for consistent querying, once per subdirectory
+                base_properties = {
+                    "doc_type": "chunk",
+                    "brand": metadata.get("brand", "").lower(),
+                    "model": metadata.get("model", "").lower(),
+                    "product_type": metadata.get("product_type", "").lower(),
+                }
                 
-            logger.info(f"Processing {len(json_files)} files in {subdir_name}...")
-            
-            # Process each JSON file
-            for json_file in json_files:
-                total_files += 1
-                file_path = os.path.join(subdir_path, json_file)
+                # Add keywords if available
+                if "keywords" in metadata and isinstance(metadata["keywords"], list):
+                    base_properties["keywords"] = ",".join(metadata["keywords"]).lower()
                 
+                subdirectories.append((subdir_path, base_properties))
+            
+            # Load the chunks in the background while earlier subdirectories are being queued, and queue each
+            # subdirectory's objects once they've been read, the batcher sends them in the background
+            for subdir_path, future in read_in_window(executor, subdirectories):
                 try:
-                    # Load the JSON data
-                    with open(file_path, 'r') as f:
-                        data = json.load(f)
-                        
-                    # Validate required fields
-                    if not all(key in data for key in ["id", "embeddings", "content"]):
-                        logger.warning(f"Skipping file {json_file}: Missing required fields.")
-                        continue
-                        
-                    # Prepare properties with lowercase values for consistent querying
-                    properties = {
-                        "content": data["content"],
-                        "doc_type": "chunk",
-                        "brand": metadata.get("brand", "").lower(),
-                        "model": metadata.get("model", "").lower(),
-                        "product_type": metadata.get("product_type", "").lower(),
-                    }
-                    
-                    # Add keywords if available
-                    if "keywords" in metadata and isinstance(metadata["keywords"], list):
-                        properties["keywords"] = ",".join(metadata["keywords"]).lower()
-                    
-                    # Insert data into Weaviate
-                    uuid = collection.data.insert(
-                        uuid=data["id"],
-                        vector=data["embeddings"],
+                    chunks = future.result()
+                except FileNotFoundError as e:
+                    logger.warning(f"Skipping subdirectory {subdir_path}: {str(e)}")
+                    all_read = False
+                    continue
+                except Exception as e:
+                    logger.error(f"Error processing subdirectory {subdir_path}: {str(e)}")
+                    all_read = False
+                    continue
+                
+                logger.info(f"Processing {len(chunks)} chunks in {subdir_path}...")
+                total_chunks += len(chunks)
+                
+                for uuid, vector, properties in chunks:
+                    current_ids.add(uuid)
+                    batch.add_object(
+                        uuid=uuid,
+                        vector=vector,
                         properties=properties
                     )
-                    
-                    successful_imports += 1
-                    if successful_imports % 10 == 0:
-                        logger.info(f"Imported {successful_imports} documents so far...")
-                        
-                except json.JSONDecodeError:
-                    logger.error(f"Invalid JSON format in file: {file_path}")
-                except KeyError as ke:
-                    logger.error(f"Missing key in file {file_path}: {str(ke)}")
-                except Exception as e:
-                    logger.error(f"Error processing file {file_path}: {str(e)}")
+                
+                    queued_imports += 1
+                    if queued_imports % 100 == 0:
+                        logger.info(f"Queued {queued_imports} documents so far ({batch.number_errors} errors)...")
+        
+        # Objects are only confirmed once the batch has been flushed
+        failed_objects = collection.batch.failed_objects
+        for failed_object in failed_objects:
+            logger.error(f"Failed to import object {failed_object.object_.uuid}: {failed_object.message}")
+        successful_imports = queued_imports - len(failed_objects)
+        
+        # Chunk files are rebuilt on every run, so objects missing from all of them are outdated text
+        if all_read and not failed_objects:
+            deleted = delete_stale_objects(collection, current_ids)
+            logger.info(f"Deleted {deleted} objects no longer in any chunk file.")
+        else:
+            logger.warning("Not deleting outdated objects, some chunks could not be read or imported.")
     
     except Exception as e:
         logger.error(f"Error during embedding import: {str(e)}")
         traceback.print_exc()
     
-    logger.info(f"Import summary: Successfully imported {successful_imports} out of {total_files} files.")
+    logger.info(f"Import summary: Successfully imported {successful_imports} out of {total_chunks} chunks.")
 
 
 def main():
@@ -167,7 +260,7 @@ def main():
         logger.info("Starting Weaviate document loader utility")
         
         # Connect to Weaviate
-        client = connect_to_weaviate()
+        client = _get_client()
         
         # Check/setup collection
         collection = check_and_setup_collection(client)
@@ -175,8 +268,6 @@ def main():
         # Load embeddings
         load_embeddings(collection, ROOT_FOLDER)
         
-        # Close connection
-        client.close()
         logger.info("Document loading completed successfully.")
         
     except KeyboardInterrupt:
@@ -2,59 +2,245 @@
 import os
 from pathlib import Path
 import json
+import orjson
 import uuid
-import re
 from datetime import datetime
 import sys
+import time
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from multiprocessing import BoundedSemaphore, Pool
 from tqdm import tqdm  # Using standard tqdm instead of notebook version
 from unstructured.partition.md import partition_md
 from unstructured.chunking.title import chunk_by_title
 from unstructured.chunking.basic import chunk_elements
 import anthropic
 
+CONTEXT_MODEL = "claude-3-haiku-20240307"
+BATCH_POLL_INTERVAL = 10  # Seconds between Message Batches status checks
+BATCH_TIMEOUT = 3600  # Seconds to wait on batches before falling back to individual requests
+BATCH_MAX_BYTES = 200 * 1024 * 1024  # Stay under the 256 MB Message Batches request size limit
+BATCH_MAX_REQUESTS = 100_000
+BATCH_REQUEST_OVERHEAD = 4096  # Bytes for the prompt templates and JSON wrapping of each request
+CONTEXT_CACHE_PATH = "output/context_cache.sqlite"
+CONTEXT_ERROR = "Error generating context"
+CONTEXT_WORKERS = 12  # Concurrent situate_context requests per process when not batching
+MAX_PROCESSES = 8  # Documents processed at the same time
+MAX_CONCURRENT_REQUESTS = 16  # Claude requests in flight across all processes, size to the account's rate limits
+CHUNKS_FILENAME = "chunks.jsonl"  # One line per chunk, in each document's output folder
+
+DOCUMENT_CONTEXT_PROMPT = """
+<document>
+{doc_content}
+</document>
+"""
+
+CHUNK_CONTEXT_PROMPT = """
+Here is the chunk we want to situate within the whole document
+<chunk>
+{chunk_content}
+</chunk>
+
+Please give a short succinct context to situate this chunk within the overall document for the purposes of improving search retrieval of the chunk.
+Answer only with the succinct context and nothing else.
+"""
+
+class ContextCache:
+    """
+    Disk-backed cache of Claude outputs keyed by a hash of their inputs,
+    so re-runs only pay for documents and chunks that have changed.
+    """
+
+    def __init__(self, path: str):
+        Path(path).parent.mkdir(exist_ok=True, parents=True)
+        # Shared between worker threads, so serialize access ourselves. Worker processes each open
+        # their own connection, WAL lets them read while another one writes.
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.lock = threading.Lock()
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS contexts (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        self.connection.commit()
+
+    @staticmethod
+    def context_key(doc: str, chunk: str) -> str:
+        digest = hashlib.blake2b(doc.encode() + b'\0' + chunk.encode(), digest_size=16).hexdigest()
+        return f"context:{CONTEXT_MODEL}:{digest}"
+
+    @staticmethod
+    def classify_key(doc: str) -> str:
+        digest = hashlib.blake2b(doc.encode(), digest_size=16).hexdigest()
+        return f"classify:{CONTEXT_MODEL}:{digest}"
+
+    def get(self, key: str):
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM contexts WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set(self, key: str, value: str) -> None:
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO contexts (key, value) VALUES (?, ?)", (key, value))
+            self.connection.commit()
+
+    def close(self) -> None:
+        self.connection.close()
+
+def context_request_params(doc: str, chunk: str):
+    return {
+        "model": CONTEXT_MODEL,
+        "max_tokens": 1024,
+        "temperature": 0.0,
+        "messages": [
+            {
+                "role": "user", 
+                "content": [
+                    {
+                        "type": "text",
+                        "text": DOCUMENT_CONTEXT_PROMPT.format(doc_content=doc),
+                        "cache_control": {"type": "ephemeral"} # Cache full document context
+                    },
+                    {
+                        "type": "text",
+                        "text": CHUNK_CONTEXT_PROMPT.format(chunk_content=chunk),
+                    },
+                ]
+            },
+        ]
+    }
+
 def situate_context(client, doc: str, chunk: str):
     try:
-        DOCUMENT_CONTEXT_PROMPT = """
-        <document>
-        {doc_content}
-        </document>
-        """
-
-        CHUNK_CONTEXT_PROMPT = """
-        Here is the chunk we want to situate within the whole document
-        <chunk>
-        {chunk_content}
-        </chunk>
-
-        Please give a short succinct context to situate this chunk within the overall document for the purposes of improving search retrieval of the chunk.
-        Answer only with the succinct context and nothing else.
-        """
-
-        response = client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=1024,
-            temperature=0.0,
-            messages=[
-                {
-                    "role": "user", 
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": DOCUMENT_CONTEXT_PROMPT.format(doc_content=doc),
-                            "cache_control": {"type": "ephemeral"} # Cache full document context
-                        },
-                        {
-                            "type": "text",
-                            "text": CHUNK_CONTEXT_PROMPT.format(chunk_content=chunk),
-                        },
-                    ]
-                },
-            ]
-        )
+        with _REQUEST_SEMAPHORE or nullcontext():
+            response = client.messages.create(**context_request_params(doc, chunk))
         return response.content[0].text
     except Exception as e:
         print(f"Error in situate_context: {e}")
-        return "Error generating context"
+        return CONTEXT_ERROR
+
+def situate_context_cached(client, cache: ContextCache, doc: str, chunk: str):
+    key = cache.context_key(doc, chunk)
+    if (context := cache.get(key)) is not None:
+        return context
+    context = situate_context(client, doc, chunk)
+    # Failed requests are retried on the next run rather than cached
+    if context != CONTEXT_ERROR:
+        cache.set(key, context)
+    return context
+
+def split_batches(doc: str, chunk_records):
+    """Group chunk records into lists whose batch requests fit under the Message Batches limits."""
+    # Every request carries the whole document, so long manuals need several batches
+    doc_size = len(doc.encode('utf-8')) + BATCH_REQUEST_OVERHEAD
+    batches, current, current_size = [], [], 0
+    for record in chunk_records:
+        size = doc_size + len(record["content"].encode('utf-8'))
+        if current and (current_size + size > BATCH_MAX_BYTES or len(current) >= BATCH_MAX_REQUESTS):
+            batches.append(current)
+            current, current_size = [], 0
+        current.append(record)
+        current_size += size
+    if current:
+        batches.append(current)
+    return batches
+
+def situate_context_batch(client, doc: str, chunk_records):
+    # Message Batches are half the price of regular requests and are processed together,
+    # so a document costs one poll loop instead of one round trip per chunk
+    batch_ids = []
+    for records in split_batches(doc, chunk_records):
+        try:
+            batch = client.messages.batches.create(
+                requests=[
+                    {"custom_id": record["id"], "params": context_request_params(doc, record["content"])}
+                    for record in records
+                ]
+            )
+        except Exception as e:
+            print(f"Error creating batch for {len(records)} context requests: {e}")
+            continue
+        print(f"Submitted batch {batch.id} with {len(records)} context requests")
+        batch_ids.append(batch.id)
+
+    # Batches can take up to 24 hours, so stop waiting after BATCH_TIMEOUT and let the
+    # caller send whatever is left as individual requests. Results are collected as each
+    # batch ends, so an error later on doesn't throw away the ones already paid for.
+    deadline = time.monotonic() + BATCH_TIMEOUT
+    pending = set(batch_ids)
+    contexts = {}
+    try:
+        while pending:
+            for batch_id in list(pending):
+                try:
+                    if client.messages.batches.retrieve(batch_id).processing_status != "ended":
+                        continue
+                    for result in client.messages.batches.results(batch_id):
+                        if result.result.type == "succeeded":
+                            contexts[result.custom_id] = result.result.message.content[0].text
+                except Exception as e:
+                    # Transient API errors are retried on the next poll
+                    print(f"Error checking batch {batch_id}: {e}")
+                    continue
+                pending.discard(batch_id)
+            if not pending or time.monotonic() > deadline:
+                break
+            time.sleep(BATCH_POLL_INTERVAL)
+    finally:
+        # Batches left running would keep being billed while their chunks are sent again individually
+        for batch_id in pending:
+            print(f"Cancelling unfinished batch {batch_id}")
+            try:
+                client.messages.batches.cancel(batch_id)
+            except Exception as e:
+                print(f"Error cancelling batch {batch_id}: {e}")
+    return contexts
+
+def situate_contexts(client, cache: ContextCache, doc: str, chunk_records):
+    """Return a map of chunk id to context, batching the requests that aren't cached when there is more than one."""
+    contexts = {}
+    for record in chunk_records:
+        context = cache.get(cache.context_key(doc, record["content"]))
+        if context is not None:
+            contexts[record["id"]] = context
+
+    uncached = [record for record in chunk_records if record["id"] not in contexts]
+    if len(uncached) > 1:
+        try:
+            batch_contexts = situate_context_batch(client, doc, uncached)
+            for record in uncached:
+                if record["id"] in batch_contexts:
+                    contexts[record["id"]] = batch_contexts[record["id"]]
+                    cache.set(cache.context_key(doc, record["content"]), contexts[record["id"]])
+        except Exception as e:
+            print(f"Error in situate_context_batch, falling back to individual requests: {e}")
+
+    # Single chunk documents, and any request the batch didn't complete, go through the regular API
+    # The requests are I/O bound, so overlapping them on threads hides most of the latency
+    pending = [record for record in chunk_records if record["id"] not in contexts]
+    if pending:
+        with ThreadPoolExecutor(max_workers=CONTEXT_WORKERS) as executor:
+            future_to_record = {
+                executor.submit(situate_context_cached, client, cache, doc, record["content"]): record
+                for record in pending
+            }
+            for future in tqdm(as_completed(future_to_record), total=len(pending), desc="Situating chunks"):
+                contexts[future_to_record[future]["id"]] = future.result()
+    return contexts
+
+_JSON_OPEN = "<json_output>"
+_JSON_CLOSE = "</json_output>"
+
+def extract_json_output(text: str):
+    # Literal tag boundaries, so plain string searches are enough
+    start = text.find(_JSON_OPEN)
+    if start == -1:
+        return None
+    start += len(_JSON_OPEN)
+    end = text.find(_JSON_CLOSE, start)
+    if end == -1:
+        return None
+    return text[start:end]
 
 def classify_content(client, doc: str):
     try:
@@ -100,28 +286,26 @@ def classify_content(client, doc: str):
         Present your final output within <json_output> tags, formatted as a valid JSON object.
         """
 
-        response = client.messages.create(
-            model="claude-3-haiku-20240307",
-            max_tokens=1024,
-            temperature=0.0,
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": CLASSIFIER_PROMPT.format(doc_content=doc)
-                        }
-                    ]
-                },
-            ]
-        )
-
-        # Pattern to match content between <json_output> tags
-        pattern = r'<json_output>(.*?)</json_output>'
-        
-        # Use re.DOTALL to make '.' match newlines as well
-        match = re.search(pattern, response.content[0].text, re.DOTALL)
+        with _REQUEST_SEMAPHORE or nullcontext():
+            response = client.messages.create(
+                model=CONTEXT_MODEL,
+                max_tokens=1024,
+                temperature=0.0,
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "type": "text",
+                                "text": CLASSIFIER_PROMPT.format(doc_content=doc)
+                            }
+                        ]
+                    },
+                ]
+            )
+
+        # Find the content between <json_output> tags
+        json_str = extract_json_output(response.content[0].text)
 
         empty_object = {
             "brand": "",
@@ -130,11 +314,10 @@ def classify_content(client, doc: str):
             "keywords": []
         }
 
-        if match:
+        if json_str is not None:
             try:
-                # Extract the JSON string and parse it
-                json_str = match.group(1).strip()
-                return json.loads(json_str)
+                # Parse the extracted JSON string
+                return json.loads(json_str.strip())
             except json.JSONDecodeError as e:
                 print(f"Error parsing JSON: {e}")
                 return empty_object
@@ -149,7 +332,57 @@ def classify_content(client, doc: str):
             "keywords": []
         }
 
-def process_document(client, file_path, input_folder, output_folder):
+def classify_content_cached(client, cache: ContextCache, doc: str):
+    key = cache.classify_key(doc)
+    if (cached := cache.get(key)) is not None:
+        return json.loads(cached)
+    doc_metadata = classify_content(client, doc)
+    # Errors come back with an empty brand, "Unknown" is a real answer
+    if doc_metadata.get("brand"):
+        cache.set(key, json.dumps(doc_metadata))
+    return doc_metadata
+
+def chunk_id(source_file: str, text: str) -> str:
+    # Content-addressed, so re-runs produce the same ids and Weaviate imports overwrite instead of duplicating.
+    # The source file is part of the hash so boilerplate shared between manuals keeps each manual's metadata.
+    digest = hashlib.blake2b(source_file.encode() + b'\0' + text.encode(), digest_size=16).digest()
+    return str(uuid.UUID(bytes=digest))
+
+def load_chunk_records(chunks_path: str) -> dict:
+    """Return the chunks already written to a document's chunks.jsonl, keyed by id in file order."""
+    records = {}
+    try:
+        with open(chunks_path, 'rb') as f:
+            for line in f:
+                try:
+                    record = orjson.loads(line)
+                    record_id = record["id"]
+                except (orjson.JSONDecodeError, KeyError):
+                    # A line cut short by an interrupted run, the chunk gets situated again
+                    continue
+                # Placeholders written by older runs are situated again as well
+                if record.get("contextualization") != CONTEXT_ERROR:
+                    records[record_id] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+# Initialized once per worker process, clients and connections can't be pickled to send with each task
+_CLIENT = None
+_CACHE = None
+_REQUEST_SEMAPHORE = None
+
+def init_worker(request_semaphore):
+    global _CLIENT, _CACHE, _REQUEST_SEMAPHORE
+    _CLIENT = anthropic.Client(
+        max_retries=4
+    )
+    _CACHE = ContextCache(CONTEXT_CACHE_PATH)
+    _REQUEST_SEMAPHORE = request_semaphore
+
+def process_document(client, cache, file_path, input_folder, output_folder):
+    client = client or _CLIENT
+    cache = cache or _CACHE
     try:
         md_file = os.path.basename(file_path)
         print(f"Processing: {md_file}")
@@ -164,31 +397,43 @@ def process_document(client, file_path, input_folder, output_folder):
         
         elements = partition_md(filename=file_path)
 
+        # All chunks from this run of the document share one timestamp
+        created_at = datetime.now().isoformat()
+
         # Not chunking tables, so pulling them out
         tables = []
         for element in elements:
             if element.category == "Table":
                 tables.append(element)
             
-        for table in tqdm(tables, desc="Processing tables"):
-            # Create metadata
+        # chunks.jsonl is rebuilt from this run's chunks, so text that is no longer in the document
+        # (e.g. a re-converted page) is dropped. Chunks a previous run already situated are reused as is.
+        chunks_path = os.path.join(output_folder_chunk_path, CHUNKS_FILENAME)
+        stored_records = load_chunk_records(chunks_path)
+        records = []
+        chunk_records = []
+        seen_ids = set()
+        for table in tables:
+            # Chunks repeated within this document are only kept once
+            record_id = chunk_id(md_file, table.text)
+            if record_id in seen_ids:
+                continue
+            seen_ids.add(record_id)
+            if record_id in stored_records:
+                records.append(stored_records[record_id])
+                continue
+            # Create metadata, the context is filled in once every chunk has been collected
             chunk_data = {
-                "id": str(uuid.uuid4()),
+                "id": record_id,
                 "source_file": md_file,
                 "category": "Table",
                 "content": table.text,
-                "contextualization": situate_context(client, document, table.text),
+                "contextualization": None,
                 "raw_table": table.metadata.text_as_html,
-                "created_at": datetime.now().isoformat()
+                "created_at": created_at
             }
-
-            # Generate unique filename using UUID
-            filename = f"{chunk_data['id']}.json"
-            output_path = os.path.join(output_folder_chunk_path, filename)
-
-            # Save chunk as JSON file
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(chunk_data, f, ensure_ascii=False, indent=2)
+            records.append(chunk_data)
+            chunk_records.append(chunk_data)
 
         # "For technical manuals, I recommend larger chunk sizes around 300-500 tokens with semantic boundaries."
         # "Use 10% overlap to preserve cross-references."
@@ -200,36 +445,61 @@ def process_document(client, file_path, input_folder, output_folder):
             overlap=60
         )
 
-        for chunk in tqdm(chunks, desc="Processing chunks"):
+        for chunk in chunks:
             if chunk.category in ["Table", "TableChunk"]:
                 continue
+            record_id = chunk_id(md_file, chunk.text)
+            if record_id in seen_ids:
+                continue
+            seen_ids.add(record_id)
+            if record_id in stored_records:
+                records.append(stored_records[record_id])
+                continue
             # Create metadata
             chunk_data = {
-                "id": str(uuid.uuid4()),
+                "id": record_id,
                 "source_file": md_file,
                 "category": chunk.category,
                 "content": chunk.text,
-                "contextualization": situate_context(client, document, chunk.text),
-                "created_at": datetime.now().isoformat()
+                "contextualization": None,
+                "created_at": created_at
             }
-
-            # Generate unique filename using UUID
-            filename = f"{chunk_data['id']}.json"
-            output_path = os.path.join(output_folder_chunk_path, filename)
-
-            # Save chunk as JSON file
-            with open(output_path, 'w', encoding='utf-8') as f:
-                json.dump(chunk_data, f, ensure_ascii=False, indent=2)
+            records.append(chunk_data)
+            chunk_records.append(chunk_data)
+
+        # Situate all new chunks in one go, then write them out
+        contexts = situate_contexts(client, cache, document, chunk_records)
+
+        for chunk_data in chunk_records:
+            chunk_data["contextualization"] = contexts[chunk_data["id"]]
+
+        # Chunks whose context failed are left out, so the next run retries them instead of
+        # reusing them and embedding the placeholder
+        failed = sum(1 for chunk_data in chunk_records if chunk_data["contextualization"] == CONTEXT_ERROR)
+        if failed:
+            print(f"Skipping {failed} chunks without context, they are retried on the next run")
+            records = [chunk_data for chunk_data in records if chunk_data["contextualization"] != CONTEXT_ERROR]
+
+        # Only rewrite the file when its chunks changed, its mtime tells chunks_to_embeddings to re-embed.
+        # The new file is written next to the old one and swapped in, so an interrupted run keeps the old one.
+        chunks_output = b"".join(orjson.dumps(chunk_data) + b"\n" for chunk_data in records)
+        try:
+            unchanged = Path(chunks_path).read_bytes() == chunks_output
+        except FileNotFoundError:
+            unchanged = False
+        if not unchanged:
+            temp_path = chunks_path + ".tmp"
+            Path(temp_path).write_bytes(chunks_output)
+            os.replace(temp_path, chunks_path)
 
         # Create metadata.json file to classify the pdf as a whole
         print("Generating document metadata...")
-        doc_metadata = classify_content(client, document)
+        doc_metadata = classify_content_cached(client, cache, document)
         metadata_filename = f"metadata.json"
         metadata_output_path = os.path.join(output_folder_chunk_path, metadata_filename)
 
         # Save metadata
-        with open(metadata_output_path, 'w', encoding='utf-8') as f:
-            json.dump(doc_metadata, f, ensure_ascii=False, indent=2)
+        Path(metadata_output_path).write_bytes(orjson.dumps(doc_metadata, option=orjson.OPT_INDENT_2))
             
         print(f"Completed processing {md_file}")
         return True
@@ -245,9 +515,9 @@ def main():
     # Create output folder if it doesn't exist
     Path(output_folder).mkdir(exist_ok=True, parents=True)
 
-    # Initialize Claude client
+    # Check a Claude client can be created before starting the workers, each of which makes its own
     try:
-        client = anthropic.Client(
+        anthropic.Client(
             max_retries=4
         )
     except Exception as e:
@@ -256,7 +526,8 @@ def main():
         sys.exit(1)
 
     # Get all Markdown files in the input folder
-    md_files = [os.path.join(input_folder, f) for f in os.listdir(input_folder) if f.lower().endswith('.md')]
+    with os.scandir(input_folder) as entries:
+        md_files = [entry.path for entry in entries if entry.is_file() and entry.name.lower().endswith('.md')]
 
     if not md_files:
         print(f"No markdown files found in {input_folder}")
@@ -264,12 +535,15 @@ def main():
 
     print(f"Found {len(md_files)} markdown files to process")
     
-    # Process each Markdown file
-    success_count = 0
-    for file_path in md_files:
-        result = process_document(client, file_path, input_folder, output_folder)
-        if result:
-            success_count += 1
+    # Process the Markdown files in parallel, they're independent of each other.
+    # Every process's threads share one limit on requests in flight, so they don't run into 429s together.
+    request_semaphore = BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+    with Pool(processes=min(os.cpu_count() or 1, MAX_PROCESSES), initializer=init_worker, initargs=(request_semaphore,)) as pool:
+        results = pool.starmap(
+            process_document,
+            [(None, None, file_path, input_folder, output_folder) for file_path in md_files]
+        )
+    success_count = sum(1 for result in results if result)
 
     print(f"Processing complete. Successfully processed {success_count}/{len(md_files)} files.")
 
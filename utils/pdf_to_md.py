@@ -2,25 +2,48 @@
 import os
 import json
 import argparse
+import hashlib
 from pathlib import Path
 import fitz  # PyMuPDF
 import anthropic
 import time
 from tqdm import tqdm  # Standard tqdm instead of notebook version
-import base64
-import re
+import pybase64
 import sys
+import random
+from contextlib import nullcontext
+from multiprocessing import BoundedSemaphore, Pool
 
-def main():
-    # Parse command line arguments
-    parser = argparse.ArgumentParser(description='Convert PDF files to markdown using Claude API')
-    parser.add_argument('input_folder', help='Directory containing PDF files to process', default="documents", nargs='?')
-    args = parser.parse_args()
-    
-    # Configuration
-    input_folder = args.input_folder
-    output_folder = "output/extractions"
-    prompt = """Please follow these instructions carefully:
+MAX_PROCESSES = 8  # PDFs converted at the same time
+MAX_CONCURRENT_REQUESTS = 4  # Claude requests in flight across all processes, size to the account's rate limits
+MAX_API_RETRIES = 5
+RETRY_BASE_DELAY = 2  # Seconds, doubled on each retry
+MAX_EXTRACTION_ATTEMPTS = 3
+TEXT_MODEL = "claude-3-5-haiku-latest"  # Converts text-only pages, supports the same 8192 max_tokens as Sonnet
+MIN_TEXT_CHARS = 200  # Pages with less extracted text than this are likely scanned or mostly figures
+
+_MD_OPEN = "<markdown_output>"
+_MD_CLOSE = "</markdown_output>"
+
+def extract_markdown(text):
+    # Literal tag boundaries, so plain string searches are enough
+    start = text.find(_MD_OPEN)
+    if start == -1:
+        return None
+    start += len(_MD_OPEN)
+    end = text.find(_MD_CLOSE, start)
+    if end == -1:
+        return None
+    return text[start:end]
+
+def page_to_pdf_bytes(doc, page_num):
+    # Claude's output is capped at 8192 tokens, so whole manuals have to be sent a page at a time.
+    # The single page document is closed straight away rather than left for the garbage collector.
+    with fitz.open() as page_pdf:
+        page_pdf.insert_pdf(doc, from_page=page_num, to_page=page_num)
+        return page_pdf.tobytes()
+
+PROMPT = """Please follow these instructions carefully:
 
 1. Analyze the PDF content thoroughly.
 
@@ -61,14 +84,227 @@ Example output structure:
 
 Please proceed with your analysis and conversion of the PDF content."""
 
+TEXT_PROMPT = """Convert the following text, extracted from one page of a technical manual, to markdown.
+
+- Ignore page headers and footers, such as page numbers, document names, or running section titles.
+- Restore headings, bullet points, bold text, and italics where the structure of the text makes them clear.
+- Do not exclude any sections, summarize them, or truncate for length.
+
+<page_text>
+{page_text}
+</page_text>
+
+Provide the converted markdown content in <markdown_output></markdown_output> tags without any additional commentary."""
+
+# Initialized once per worker process, clients can't be pickled to send with each task
+_CLIENT = None
+_REQUEST_SEMAPHORE = None
+
+def init_worker(request_semaphore):
+    global _CLIENT, _REQUEST_SEMAPHORE
+    # Retries are handled by create_message, so they aren't multiplied by the client's own
+    _CLIENT = anthropic.Client(max_retries=0)
+    _REQUEST_SEMAPHORE = request_semaphore
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+def create_message(client, **params):
+    """Call Claude, backing off exponentially with full jitter on rate limits, overloads and server errors."""
+    for attempt in range(MAX_API_RETRIES):
+        try:
+            with _REQUEST_SEMAPHORE or nullcontext():
+                return client.messages.create(**params)
+        except (anthropic.APIStatusError, anthropic.APIConnectionError) as e:
+            retryable = not isinstance(e, anthropic.APIStatusError) or e.status_code == 429 or e.status_code >= 500
+            if not retryable or attempt == MAX_API_RETRIES - 1:
+                raise
+            # Use the server's retry-after when it sends one, it knows when quota frees up
+            delay = retry_after(e) or random.uniform(0, RETRY_BASE_DELAY * 2 ** attempt)
+            print(f"  API error, retrying in {delay:.1f} seconds (attempt {attempt+1}/{MAX_API_RETRIES}): {e}")
+            time.sleep(delay)
+
+def file_digest(file_path):
+    """Hash a file's contents in 1 MB reads, so a replaced PDF gets fresh checkpoints."""
+    digest = hashlib.blake2b(digest_size=8)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def process_pdf(client, file_path, output_folder):
+    client = client or _CLIENT
+    pdf_file = os.path.basename(file_path)
+    print(f"Processing: {pdf_file}")
+    
+    # Prepare variables
+    filename_base = os.path.splitext(pdf_file)[0]
+    doc = None
+    page_count = 0
+    
+    # Prepare the results container for this PDF
+    pdf_results = {
+        'filename': pdf_file,
+        'path': file_path,
+        'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'pages': []
+    }
+
+    try:
+        # Every converted page is checkpointed, so a failed run resumes where it stopped.
+        # Deleting a page's file makes the next run convert just that page again.
+        # The folder is keyed by the PDF's contents, so replacing a PDF under the same name starts over.
+        checkpoint_dir = Path(output_folder) / ".cache" / f"{filename_base}-{file_digest(file_path)}"
+        checkpoint_dir.mkdir(exist_ok=True, parents=True)
+        # Only NNNN.md files are page checkpoints, anything else in the folder is ignored
+        converted_pages = {int(path.stem) for path in checkpoint_dir.glob('*.md') if path.stem.isdigit()}
+        
+        # Open the PDF
+        doc = fitz.open(file_path)
+        page_count = len(doc)
+        
+        # Process each page
+        for page_num in tqdm(range(len(doc)), desc=f"Pages in {pdf_file}"):
+            if page_num + 1 in converted_pages:
+                pdf_results['pages'].append({
+                    'page_number': page_num + 1,
+                    'status': 'checkpoint'
+                })
+                continue
+
+            # Text-native pages convert just as well from their extracted text, at a fraction of the tokens.
+            # Pages with images or vector drawings (diagrams, ruled tables) need Claude to see the layout.
+            page = doc[page_num]
+            page_text = page.get_text().strip()
+            if len(page_text) > MIN_TEXT_CHARS and not page.get_images() and not page.get_drawings():
+                conversion = 'text'
+                request = {
+                    "model": TEXT_MODEL,
+                    "max_tokens": 8192,
+                    "messages": [
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": TEXT_PROMPT.format(page_text=page_text)}
+                            ]
+                        }
+                    ]
+                }
+            else:
+                conversion = 'pdf'
+                # Copy the page into its own pdf and get binary info
+                page_bytes = page_to_pdf_bytes(doc, page_num)
+                base64_string = pybase64.b64encode_as_string(page_bytes)
+                request = {
+                    "model": "claude-3-7-sonnet-latest",
+                    "max_tokens": 8192,
+                    "system": "You are an advanced AI assistant specializing in PDF content analysis and conversion. Your task is to convert the provided PDF content into markdown format while adhering to specific guidelines.",
+                    "messages": [
+                        {
+                            "role": "user", 
+                            "content": [
+                                {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": base64_string}},
+                                {"type": "text", "text": PROMPT}
+                            ]
+                         }
+                    ]
+                }
+            
+            # Ask again if the markdown tags are missing, API errors are retried by create_message
+            for attempt in range(MAX_EXTRACTION_ATTEMPTS):
+                if attempt > 0:
+                    print(f"  Retry {attempt} for page {page_num+1}")
+
+                try:
+                    response = create_message(client, **request)
+                except Exception as api_error:
+                    print(f"  API error on page {page_num+1}: {api_error}")
+                    # Record the error but continue with next page
+                    pdf_results['pages'].append({
+                        'page_number': page_num + 1,
+                        'status': 'error',
+                        'retry_count': attempt,
+                        'error_message': str(api_error)
+                    })
+                    break
+
+                # Store the response in our results
+                response_text = response.content[0].text if response.content else ""
+                markdown = extract_markdown(response_text)
+
+                if markdown is not None:
+                    pdf_results['pages'].append({
+                        'page_number': page_num + 1,
+                        'status': 'success',
+                        'conversion': conversion,
+                        'retry_count': attempt,
+                        'response': response_text
+                    })
+                    (checkpoint_dir / f"{page_num + 1:04d}.md").write_text(markdown + "\n", encoding='utf-8')
+                    break
+            else:
+                print(f"  Warning: Could not extract markdown output after {MAX_EXTRACTION_ATTEMPTS} attempts on page {page_num+1}")
+                pdf_results['pages'].append({
+                    'page_number': page_num + 1,
+                    'status': 'warning',
+                    'retry_count': MAX_EXTRACTION_ATTEMPTS - 1,
+                    'warning': "Could not extract markdown output after maximum retries",
+                    'response': response_text
+                })
+        
+    except Exception as e:
+        print(f"Error processing {pdf_file}: {e}")
+        pdf_results['error'] = str(e)
+    
+    finally:
+        # Close the document if it was successfully opened
+        if doc is not None:
+            try:
+                doc.close()
+            except Exception as close_error:
+                print(f"Warning: Could not close document properly: {close_error}")
+        
+        # Save results for this PDF from the page checkpoints, even if partial due to errors.
+        # A PDF that couldn't be read keeps its previous markdown, the error is in its results file.
+        output_file = os.path.join(output_folder, f"{filename_base}.md")
+        if page_count:
+            page_paths = (checkpoint_dir / f"{page_number:04d}.md" for page_number in range(1, page_count + 1))
+            markdown_output = "".join(path.read_text(encoding='utf-8') for path in page_paths if path.exists())
+            with open(output_file, 'w', encoding='utf-8') as f:
+                f.write(markdown_output)
+        debug_file = os.path.join(output_folder, f"{filename_base}_results.json")
+        with open(debug_file, 'w', encoding='utf-8') as f:
+            json.dump(pdf_results, f, indent=2)
+            
+        print(f"Saved results for {pdf_file} to {output_file if page_count else debug_file}")
+
+def process_pdf_task(args):
+    return process_pdf(*args)
+
+def main():
+    # Parse command line arguments
+    parser = argparse.ArgumentParser(description='Convert PDF files to markdown using Claude API')
+    parser.add_argument('input_folder', help='Directory containing PDF files to process', default="documents", nargs='?')
+    args = parser.parse_args()
+    
+    # Configuration
+    input_folder = args.input_folder
+    output_folder = "output/extractions"
+
     # Check if input directory exists
     if not os.path.isdir(input_folder):
         print(f"Error: Input directory '{input_folder}' does not exist.")
         sys.exit(1)
 
-    # Initialize Claude client
+    # Check a Claude client can be created before starting the workers, each of which makes its own
     try:
-        client = anthropic.Client()
+        anthropic.Client()
     except Exception as e:
         print(f"Error initializing Claude client: {e}")
         print("Make sure you have set your ANTHROPIC_API_KEY environment variable.")
@@ -78,7 +314,8 @@ Please proceed with your analysis and conversion of the PDF content."""
     Path(output_folder).mkdir(exist_ok=True, parents=True)
 
     # Get all PDF files in the input folder
-    pdf_files = [f for f in os.listdir(input_folder) if f.lower().endswith('.pdf')]
+    with os.scandir(input_folder) as entries:
+        pdf_files = [entry for entry in entries if entry.is_file() and entry.name.lower().endswith('.pdf')]
     
     if not pdf_files:
         print(f"No PDF files found in '{input_folder}'.")
@@ -87,129 +324,11 @@ Please proceed with your analysis and conversion of the PDF content."""
     print(f"Found {len(pdf_files)} PDF files to process.")
 
     # Process each PDF file
-    for pdf_file in tqdm(pdf_files, desc="Processing PDF files"):
-        file_path = os.path.join(input_folder, pdf_file)
-        print(f"Processing: {pdf_file}")
-        
-        # Prepare variables
-        filename_base = os.path.splitext(pdf_file)[0]
-        doc = None
-        
-        # Prepare the results container for this PDF
-        pdf_results = {
-            'filename': pdf_file,
-            'path': file_path,
-            'timestamp': time.strftime('%Y-%m-%d %H:%M:%S'),
-            'pages': []
-        }
-
-        markdown_output = ""
-        
-        try:
-            # Open the PDF
-            doc = fitz.open(file_path)
-            
-            # Process each page
-            for page_num in tqdm(range(len(doc)), desc=f"Pages in {pdf_file}"):
-                # Create empty pdf, insert page, and then get binary info
-                page_pdf = fitz.open()
-                page_pdf.insert_pdf(doc, from_page=page_num, to_page=page_num)
-                page_bytes = page_pdf.tobytes()
-                base64_string = base64.b64encode(page_bytes).decode("utf-8")
-                
-                # Call Claude API with retries
-                max_retries = 3
-                retry_count = 0
-                success = False
-
-                while retry_count < max_retries and not success:
-                    try:
-                        if retry_count > 0:
-                            print(f"  Retry {retry_count} for page {page_num+1}")
-                            # Longer delay for retries
-                            time.sleep(2)
-                        
-                        response = client.messages.create(
-                            model="claude-3-7-sonnet-latest",
-                            max_tokens=8192,
-                            system="You are an advanced AI assistant specializing in PDF content analysis and conversion. Your task is to convert the provided PDF content into markdown format while adhering to specific guidelines.",
-                            messages=[
-                                {
-                                    "role": "user", 
-                                    "content": [
-                                        {"type": "document", "source": {"type": "base64", "media_type": "application/pdf", "data": base64_string}},
-                                        {"type": "text", "text": prompt}
-                                    ]
-                                 }
-                            ]
-                        )
-                        
-                        # Store the response in our results
-                        if not response.content or not response.content[0].text:
-                            raise Exception("Empty response received from Claude API")
-                        
-                        pattern = r'<markdown_output>(.*?)</markdown_output>'
-                        match = re.search(pattern, response.content[0].text, re.DOTALL)
-
-                        if match:
-                            pdf_results['pages'].append({
-                                'page_number': page_num + 1,
-                                'status': 'success',
-                                'retry_count': retry_count,
-                                'response': response.content[0].text
-                            })
-                            markdown_output += match.group(1) + "\n"
-                            success = True
-                        else:
-                            if retry_count == max_retries - 1:
-                                print(f"  Warning: Could not extract markdown output after {max_retries} attempts on page {page_num+1}")
-                                pdf_results['pages'].append({
-                                    'page_number': page_num + 1,
-                                    'status': 'warning',
-                                    'retry_count': retry_count,
-                                    'warning': "Could not extract markdown output after maximum retries",
-                                    'response': response.content[0].text
-                                })
-                            retry_count += 1
-                        
-                        # Respect rate limits - add a small delay
-                        time.sleep(0.5)
-                    
-                    except Exception as api_error:
-                        if retry_count == max_retries - 1:
-                            print(f"  API error on page {page_num+1} after {max_retries} attempts: {api_error}")
-                            # Record the error but continue with next page
-                            pdf_results['pages'].append({
-                                'page_number': page_num + 1,
-                                'status': 'error',
-                                'retry_count': retry_count,
-                                'error_message': str(api_error)
-                            })
-                        else:
-                            print(f"  API error on page {page_num+1} (attempt {retry_count+1}): {api_error}")
-                            retry_count += 1
-            
-        except Exception as e:
-            print(f"Error processing {pdf_file}: {e}")
-            pdf_results['error'] = str(e)
-        
-        finally:
-            # Close the document if it was successfully opened
-            if doc is not None:
-                try:
-                    doc.close()
-                except Exception as close_error:
-                    print(f"Warning: Could not close document properly: {close_error}")
-            
-            # Save results for this PDF, even if partial due to errors
-            output_file = os.path.join(output_folder, f"{filename_base}.md")
-            with open(output_file, 'w', encoding='utf-8') as f:
-                f.write(markdown_output)
-            debug_file = os.path.join(output_folder, f"{filename_base}_results.json")
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                json.dump(pdf_results, f, indent=2)
-                
-            print(f"Saved results for {pdf_file} to {output_file}")
+    request_semaphore = BoundedSemaphore(MAX_CONCURRENT_REQUESTS)
+    with Pool(processes=min(os.cpu_count() or 1, MAX_PROCESSES), initializer=init_worker, initargs=(request_semaphore,)) as pool:
+        tasks = [(None, entry.path, output_folder) for entry in pdf_files]
+        for _ in tqdm(pool.imap_unordered(process_pdf_task, tasks), total=len(tasks), desc="Processing PDF files"):
+            pass
 
     print(f"Processing complete. Results saved to {output_folder}")
 